@@ -10,9 +10,15 @@
 Now you can use the dataset class by specifying flag '--dataset_mode dummy'.
 See our template dataset class 'template_dataset.py' for more details.
 """
+import contextlib
 import importlib
+import cv2
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import torch.utils.data
-from data.base_dataset import BaseDataset
+from data.base_dataset import BaseDataset, normalize_batch
+from data.array_cache import SharedArrayCache, shared_memory_free_bytes
 
 
 def find_dataset_using_name(dataset_name):
@@ -59,6 +65,15 @@ def create_dataset(opt):
     return dataset
 
 
+def worker_init_fn(worker_id):
+    """Set up a DataLoader worker: seed its random generators from the seed torch gives it (different for every worker
+    and epoch), and run OpenCV single-threaded, as PIL is, since the workers already run in parallel."""
+    info = torch.utils.data.get_worker_info()
+    info.dataset.rng = np.random.default_rng(info.seed)
+    np.random.seed(info.seed % 2 ** 32)
+    cv2.setNumThreads(0)
+
+
 class CustomDatasetDataLoader():
     """Wrapper class of Dataset class that performs multi-threaded data loading"""
 
@@ -66,17 +81,38 @@ class CustomDatasetDataLoader():
         """Initialize this class
 
         Step 1: create a dataset instance given the name [dataset_mode]
-        Step 2: create a multi-threaded data loader.
+        Step 2: share its image cache between the loading processes, if any
+        Step 3: create a multi-threaded data loader, which starts reading the files of the upcoming data points early.
         """
         self.opt = opt
+        self.device = torch.device('cuda:{}'.format(opt.gpu_ids[0])) if opt.gpu_ids else torch.device('cpu')
         dataset_class = find_dataset_using_name(opt.dataset_mode)
         self.dataset = dataset_class(opt)
         print("dataset [%s] was created" % type(self.dataset).__name__)
+        if opt.cache_num > 0 and int(opt.num_threads) > 0:
+            # one cache for all the workers, which are re-created at every epoch
+            cache_bytes = opt.cache_mb * 2 ** 20
+            shm_free = shared_memory_free_bytes()
+            if shm_free is not None and cache_bytes > shm_free // 2:  # leave room for the batches sent by the workers
+                cache_bytes = shm_free // 2
+                print("Warning: --cache_mb %d is more than half of the free space of /dev/shm; "
+                      "the shared image cache is limited to %d MB" % (opt.cache_mb, cache_bytes // 2 ** 20))
+            if cache_bytes > 0:
+                self.manager = multiprocessing.Manager()
+                self.dataset.cache = SharedArrayCache(opt.cache_num, cache_bytes, self.manager)
+        if opt.serial_batches:
+            sampler = torch.utils.data.SequentialSampler(self.dataset)
+        else:
+            sampler = torch.utils.data.RandomSampler(self.dataset)
+        if int(opt.num_threads) > 0:
+            sampler = ReadaheadSampler(sampler, self.dataset)
         self.dataloader = torch.utils.data.DataLoader(
             self.dataset,
             batch_size=opt.batch_size,
-            shuffle=not opt.serial_batches,
-            num_workers=int(opt.num_threads))
+            sampler=sampler,
+            num_workers=int(opt.num_threads),
+            worker_init_fn=worker_init_fn,
+            pin_memory=self.device.type == 'cuda')
 
     def load_data(self):
         return self
@@ -86,8 +122,72 @@ class CustomDatasetDataLoader():
         return min(len(self.dataset), self.opt.max_dataset_size)
 
     def __iter__(self):
-        """Return a batch of data"""
+        """Return a batch of data
+
+        On a GPU, the next batch is copied and normalized on a side CUDA stream while the current one is being used.
+        """
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        pending = None
         for i, data in enumerate(self.dataloader):
             if i * self.opt.batch_size >= self.opt.max_dataset_size:
                 break
-            yield data
+            with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+                data = self.postprocess(data)
+                ready = stream.record_event() if stream is not None else None
+            if pending is not None:
+                yield self.wait_for(*pending)
+            pending = data, ready
+        if pending is not None:
+            yield self.wait_for(*pending)
+
+    def wait_for(self, data, ready):
+        """Make the current CUDA stream wait for the batch <data> prepared on the side stream of <__iter__>."""
+        if ready is None:
+            return data
+        stream = torch.cuda.current_stream(self.device)
+        stream.wait_event(ready)
+        for value in data.values():
+            if torch.is_tensor(value) and value.is_cuda:
+                value.record_stream(stream)  # the memory was allocated on the side stream
+        return data
+
+    def postprocess(self, data):
+        """Move the uint8 images of a batch to <self.device> and normalize them there.
+
+        Transferring uint8 instead of float32 moves 4x fewer bytes from the loading processes to the device;
+        the DataLoader has already stacked every key of the batch into one pinned tensor, so the copy is asynchronous.
+        The photometric distortions are sampled per image by the dataset ('A_distort', 'B_distort'),
+        but are applied here to the whole batch at once.
+        """
+        for name in ('A', 'B'):
+            factors = data.pop(name + '_distort', None)
+            images = data.get(name)
+            if not torch.is_tensor(images) or images.dtype != torch.uint8:  # e.g., the Lab images of the colorization dataset
+                continue
+            data[name] = normalize_batch(images.to(self.device, non_blocking=True), factors)
+        return data
+
+
+class ReadaheadSampler(torch.utils.data.Sampler):
+    """Wrap a sampler so that the files of every index it yields start being read right away.
+
+    The DataLoader draws the indices in the main process, several batches ahead of the workers that load them,
+    so the disk reads (see <BaseDataset.readahead>) overlap with the decoding of the previous data points.
+    The hints are issued by a background thread, so that opening the files does not hold up the training loop.
+    """
+
+    def __init__(self, sampler, dataset):
+        self.sampler = sampler
+        self.dataset = dataset
+
+    def __iter__(self):
+        pool = ThreadPoolExecutor(1)
+        try:
+            for index in self.sampler:
+                pool.submit(self.dataset.readahead, index)
+                yield index
+        finally:
+            pool.shutdown(wait=False)
+
+    def __len__(self):
+        return len(self.sampler)
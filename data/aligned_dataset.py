@@ -1,11 +1,8 @@
 import os
-import json
-import random
-import io
+import numpy as np
 
-from data.base_dataset import BaseDataset, get_params, get_transform, transparent_to_whiteBK
+from data.base_dataset import BaseDataset, get_distort_factors, sample_params, compile_transform, decode_image, resize_image, alpha_mode, alpha_to_white
 from data.image_folder import make_dataset
-from PIL import Image
 
 
 class AlignedDataset(BaseDataset):
@@ -23,14 +20,22 @@ class AlignedDataset(BaseDataset):
         """
         BaseDataset.__init__(self, opt)
         self.dir_AB = os.path.join(opt.dataroot, opt.phase)  # get the image directory
-        self.AB_paths = sorted(make_dataset(self.dir_AB, opt.max_dataset_size))  # get image paths
-        if opt.repeat_dataset_count > 1:
-            temp = self.AB_paths.copy()
-            for n in range(opt.repeat_dataset_count-1):
-                self.AB_paths.extend(temp)
+        AB_paths = [os.fsencode(p) for p in sorted(make_dataset(self.dir_AB, opt.max_dataset_size))]  # get image paths
+        # one bytes object and an offset array instead of a list of str: each worker process would otherwise
+        # copy the pages of every str object as soon as it touches their reference counts
+        self.AB_path_bytes = b''.join(AB_paths)
+        self.AB_path_offsets = np.zeros(len(AB_paths) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in AB_paths], out=self.AB_path_offsets[1:])
+        self.AB_size = len(AB_paths)
+        self.repeat_count = max(1, opt.repeat_dataset_count)
         assert(self.opt.load_size >= self.opt.crop_size)   # crop_size should be smaller than the size of loaded image
         self.input_nc = self.opt.output_nc if self.opt.direction == 'BtoA' else self.opt.input_nc
         self.output_nc = self.opt.input_nc if self.opt.direction == 'BtoA' else self.opt.output_nc
+        self.augment_probs = np.array([opt.agument_whiteBK_A, opt.agument_grayscale_A, opt.agument_grayscale_B,
+                                       opt.agument_blur_A, opt.agument_blur_B, opt.agument_distort_A, opt.agument_distort_B,
+                                       opt.agument_whiteBK_A], dtype=np.float64)
+        self.transform_A = compile_transform(opt, grayscale=(self.input_nc == 1))
+        self.transform_B = compile_transform(opt, grayscale=(self.output_nc == 1))
 
     def __getitem__(self, index):
         """Return a data point and its metadata information.
@@ -43,43 +48,66 @@ class AlignedDataset(BaseDataset):
             B (tensor) - - its corresponding image in the target domain
             A_paths (str) - - image paths
             B_paths (str) - - image paths (same as A_paths)
+            A_distort, B_distort (tensor) - - the photometric distortions of A and B, applied per batch (see <distort_batch>)
         """
         # read a image given a random integer index
-        AB_path = self.AB_paths[index]
-        AB = Image.open(io.BytesIO(self.get_cache_path(self, AB_path)))
-        # split AB image into A and B
-        w, h = AB.size
-        w2 = int(w / 2)
-        A = AB.crop((0, 0, w2, h))
-        B = AB.crop((w2, 0, w, h))
-        
-        
-        if random.random() < self.opt.agument_whiteBK_A:
-            A = transparent_to_whiteBK(A)
-        A = A.convert('RGB')
-        B = B.convert('RGB')
-
+        AB_path = self.get_AB_path(index)
+        A, B = self.get_cached_array(AB_path)
 
         # apply the same transform to both A and B
-        transform_params_A = get_params(self.opt, A.size)
-        transform_params_B = json.loads(json.dumps(transform_params_A))
-        transform_params_A['grayscale'] = random.random() < self.opt.agument_grayscale_A
-        transform_params_B['grayscale'] = random.random() < self.opt.agument_grayscale_B
-        transform_params_A['blur'] = random.random() < self.opt.agument_blur_A
-        transform_params_B['blur'] = random.random() < self.opt.agument_blur_B
-        transform_params_A['distort'] = random.random() < self.opt.agument_distort_A
-        transform_params_B['distort'] = random.random() < self.opt.agument_distort_B
-        transform_params_B['whiteBK'] = random.random() < self.opt.agument_whiteBK_A
-
-        A_transform = get_transform(self.opt, transform_params_A, grayscale=(self.input_nc == 1))
-        B_transform = get_transform(self.opt, transform_params_B, grayscale=(self.output_nc == 1))
+        transform_params_A, r = sample_params(self.opt, (A.shape[1], A.shape[0]), self.augment_probs, self.rng)
+        if A.shape[2] == 4:
+            A = alpha_to_white(A) if r[0] else A[:, :, :3]
+        transform_params_B = dict(transform_params_A)
+        transform_params_A['grayscale'] = r[1]
+        transform_params_B['grayscale'] = r[2]
+        transform_params_A['blur'] = r[3]
+        transform_params_B['blur'] = r[4]
+        transform_params_A['distort'] = r[5]
+        transform_params_B['distort'] = r[6]
+        transform_params_B['whiteBK'] = r[7]
+
+        A = self.transform_A(A, transform_params_A, self.rng)
+        B = self.transform_B(B, transform_params_B, self.rng)
+
+        return {'A': A, 'B': B, 'A_paths': AB_path, 'B_paths': AB_path,
+                'A_distort': get_distort_factors(transform_params_A['distort'], transform_params_A['grayscale'], rng=self.rng),
+                'B_distort': get_distort_factors(transform_params_B['distort'], transform_params_B['grayscale'], rng=self.rng)}
+
+    def get_paths(self, index):
+        """Return the path of the AB image of data point <index>."""
+        return [self.get_AB_path(index)]
+
+    def get_AB_path(self, index):
+        """Return the path of the AB image of data point <index>; the dataset repeats itself opt.repeat_dataset_count times."""
+        i = index % self.AB_size
+        return os.fsdecode(self.AB_path_bytes[self.AB_path_offsets[i]:self.AB_path_offsets[i + 1]])
+
+    def load_array(self, path, keep_alpha=True):
+        """Decode an AB image, split it into A and B, and resize both halves as required by opt.preprocess.
+
+        A keeps its alpha channel if <keep_alpha> (see <BaseDataset.load_array>); B is always RGB.
+        """
+        A, B = self.split_AB(decode_image(self._read_bytes(path), self.opt, parts=2))
+        if not keep_alpha:
+            A = A.convert('RGB')
+        return np.asarray(resize_image(A, self.opt)), np.asarray(resize_image(B, self.opt))
 
-        A = A_transform(A)
-        B = B_transform(B)
+    @staticmethod
+    def split_AB(AB):
+        """Split an AB image into its halves A (RGB or RGBA) and B (RGB).
 
-        return {'A': A, 'B': B, 'A_paths': AB_path, 'B_paths': AB_path}
+        The image is decoded once; an RGB image (e.g., any JPEG) needs no mode conversion.
+        """
+        w, h = AB.size
+        w2 = int(w / 2)
+        if AB.mode == 'RGB':
+            return AB.crop((0, 0, w2, h)), AB.crop((w2, 0, w, h))
+        A = AB.crop((0, 0, w2, h))
+        B = AB.crop((w2, 0, w, h))
+        return A.convert(alpha_mode(AB)), B.convert('RGB')
 
     def __len__(self):
         """Return the total number of images in the dataset."""
-        return len(self.AB_paths)
+        return self.AB_size * self.repeat_count
 
@@ -0,0 +1,133 @@
+"""Caches of decoded images for <BaseDataset.get_cached_array>.
+
+The cached values are uint8 numpy arrays, or tuples of them (e.g., the A and B halves of an aligned image).
+They are returned read-only, since the same arrays are handed out for every epoch.
+
+LRUArrayCache lives in the memory of a single process.
+SharedArrayCache keeps a single copy of the images in shared memory, so that all the DataLoader workers
+fill and read the same cache instead of one private (and short-lived) cache each.
+"""
+import atexit
+import multiprocessing
+import os
+from collections import OrderedDict
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class LRUArrayCache():
+    """A least-recently-used cache bounded by both its number of entries and its size in bytes."""
+
+    def __init__(self, max_items, max_bytes):
+        """Initialize the LRUArrayCache class
+
+        Parameters:
+            max_items (int) -- the maximum number of entries; if max_items=0, nothing will be cached
+            max_bytes (int) -- the maximum total size of the cached arrays
+        """
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.items = OrderedDict()
+
+    def get(self, key):
+        """Return the arrays cached under <key>, or None."""
+        arrays = self.items.get(key)
+        if arrays is not None:
+            self.items.move_to_end(key)
+        return arrays
+
+    def put(self, key, arrays):
+        """Cache <arrays> under <key>, evicting the least recently used entries if the cache is full."""
+        nbytes = _nbytes(arrays)
+        if self.max_items <= 0 or nbytes > self.max_bytes or key in self.items:
+            return
+        for a in _as_tuple(arrays):
+            a.flags.writeable = False
+        self.items[key] = arrays
+        self.nbytes += nbytes
+        while len(self.items) > self.max_items or self.nbytes > self.max_bytes:
+            _, evicted = self.items.popitem(last=False)
+            self.nbytes -= _nbytes(evicted)
+
+
+class SharedArrayCache():
+    """A cache shared by all the processes of a DataLoader.
+
+    The pixels are appended to one shared memory block; a manager dict maps every key to the (offset, shape)
+    of its arrays in that block. Entries are never evicted: once the block (or <max_items>) is full, new images
+    are simply not cached. With shuffled epochs an LRU policy would not hit more often anyway.
+    """
+
+    def __init__(self, max_items, max_bytes, manager):
+        """Initialize the SharedArrayCache class; it must be created in the main process, before the workers start.
+
+        Parameters:
+            max_items (int)                      -- the maximum number of entries
+            max_bytes (int)                      -- the size of the shared memory block
+            manager (multiprocessing.Manager)    -- holds the index of the cache
+        """
+        self.max_items = max_items
+        self.shm = shared_memory.SharedMemory(create=True, size=max_bytes)
+        atexit.register(self.shm.unlink)
+        self.index = manager.dict()
+        self.found = {}  # the part of <index> known to this process
+        self.lock = multiprocessing.Lock()
+        self.used = multiprocessing.RawArray('q', 2)  # bytes and entries allocated so far
+
+    def get(self, key):
+        """Return the arrays cached under <key> (views of the shared memory), or None.
+
+        Entries are never evicted, so the ones already found are remembered by this process
+        and only the misses cost a round trip to the manager.
+        """
+        entry = self.found.get(key)
+        if entry is None:
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+            self.found[key] = entry
+        single, layout = entry
+        arrays = tuple(self._view(offset, shape) for offset, shape in layout)
+        return arrays[0] if single else arrays
+
+    def put(self, key, arrays):
+        """Copy <arrays> into the shared memory block, if there is room left."""
+        single = isinstance(arrays, np.ndarray)
+        nbytes = _nbytes(arrays)
+        with self.lock:
+            offset, count = self.used
+            if count >= self.max_items or offset + nbytes > self.shm.size:
+                return
+            self.used[0] = offset + nbytes
+            self.used[1] = count + 1
+        layout = []
+        for a in _as_tuple(arrays):
+            self._view(offset, a.shape, writeable=True)[...] = a
+            layout.append((offset, a.shape))
+            offset += a.nbytes
+        self.index[key] = (single, tuple(layout))
+
+    def _view(self, offset, shape, writeable=False):
+        a = np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf, offset=offset)
+        a.flags.writeable = writeable
+        return a
+
+
+def shared_memory_free_bytes():
+    """Return the free space of /dev/shm, where SharedMemory blocks are allocated, or None if it cannot be checked.
+
+    Writing past the actual size of /dev/shm (e.g., 64 MB in a default Docker container) kills the process with SIGBUS.
+    """
+    if not hasattr(os, 'statvfs') or not os.path.isdir('/dev/shm'):
+        return None
+    stat = os.statvfs('/dev/shm')
+    return stat.f_bavail * stat.f_frsize
+
+
+def _as_tuple(arrays):
+    return (arrays,) if isinstance(arrays, np.ndarray) else tuple(arrays)
+
+
+def _nbytes(arrays):
+    return sum(a.nbytes for a in _as_tuple(arrays))
@@ -1,13 +1,32 @@
 """This module implements an abstract base class (ABC) 'BaseDataset' for datasets.
 
-It also includes common transformation functions (e.g., get_transform, __scale_width), which can be later used in subclasses.
+It also includes common transformation functions (e.g., get_transform, resize_image), which can be later used in subclasses.
 """
-import random
+import os
+import io
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import cv2
 import numpy as np
+import torch
+import torch.nn.functional as F
 import torch.utils.data as data
-from PIL import Image, ImageEnhance, ImageFilter
+from PIL import Image
 import torchvision.transforms as transforms
 from abc import ABC, abstractmethod
+from data.array_cache import LRUArrayCache
+
+try:
+    from numba import njit
+except ImportError:  # numba only speeds up <sample_params>
+    def njit(*args, **kwargs):
+        return lambda f: f
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):  # PyTurboJPEG or the libturbojpeg library is missing
+    turbo_jpeg = None
 
 
 class BaseDataset(data.Dataset, ABC):
@@ -20,6 +39,8 @@ class BaseDataset(data.Dataset, ABC):
     -- <modify_commandline_options>:    (optionally) add dataset-specific options and set default options.
     """
 
+    read_threads = 4  # the number of files that <__getitems__> reads concurrently
+
     def __init__(self, opt):
         """Initialize the class; save the options in the class
 
@@ -28,17 +49,101 @@ class BaseDataset(data.Dataset, ABC):
         """
         self.opt = opt
         self.root = opt.dataroot
-        self.cache = {}
+        self.cache = LRUArrayCache(opt.cache_num, opt.cache_mb * 2 ** 20)
+        self.rng = np.random.default_rng()  # reseeded in every DataLoader worker, see <data.worker_init_fn>
+        self.pending_reads = {}  # path -> future of its bytes, see <__getitems__>
+        self.read_pool = None
+        self.read_pool_pid = None
+
+    def get_cached_array(self, path, keep_alpha=True):
+        """Return the decoded and resized image(s) stored at <path> as uint8 numpy arrays.
+
+        The arrays are produced by <load_array>. Up to opt.cache_num of them (and opt.cache_mb in total) are kept
+        in memory, so that the following epochs skip both the decoding and the resizing. The cached arrays are read-only.
+        """
+        key = (path, self.opt.load_size)
+        # the files being read by <__getitems__> are known misses, which need not be looked up again
+        arrays = None if path in self.pending_reads else self.cache.get(key)
+        if arrays is None:
+            arrays = self.load_array(path, keep_alpha)
+            self.cache.put(key, arrays)
+        return arrays
+
+    def load_array(self, path, keep_alpha=True):
+        """Decode the image at <path> and apply the deterministic resize of opt.preprocess.
+
+        The random crop/flip/rotate are left to <get_transform>. If <keep_alpha>, images with transparency are kept
+        as RGBA, so that <alpha_to_white> can still be sampled for every data point; the others are RGB.
+        """
+        img = decode_image(self._read_bytes(path), self.opt)
+        img = img.convert(alpha_mode(img) if keep_alpha else 'RGB')
+        return np.asarray(resize_image(img, self.opt))
+
+    def _read_bytes(self, path):
+        """Return the bytes of the file at <path>, which <__getitems__> may already be reading."""
+        future = self.pending_reads.pop(path, None)
+        if future is not None:
+            return future.result()
+        return self.__read_file(path)
 
     @staticmethod
-    def get_cache_path(self, path):
-        if path in self.cache:
-            return self.cache[path]
-        with open(path, 'rb') as f:
-            bts = f.read()
-        if self.opt.cache_num > len(self.cache):
-            self.cache[path] = bts
-        return bts
+    def __read_file(path):
+        """Read the whole file at <path> without buffering; <readall> reads until EOF, in a single read for most files."""
+        with io.FileIO(path) as f:
+            return f.readall()
+
+    def get_paths(self, index):
+        """Return the paths of the files that <__getitem__> reads for <index> (see <readahead>)."""
+        return []
+
+    def readahead(self, index):
+        """Ask the kernel to start reading the files of data point <index> into the page cache, without waiting for them.
+
+        The files of the images that are already cached are skipped.
+        """
+        if not hasattr(os, 'posix_fadvise'):
+            return
+        for path in self.get_paths(index):
+            if self.cache.get((path, self.opt.load_size)) is not None:
+                continue
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+
+    def __getitems__(self, indices):
+        """Return the data points of a batch (called by the DataLoader of torch>=2.0 instead of <__getitem__>).
+
+        The files of the batch that are not cached yet are read by <read_threads> threads, so that the disk
+        (or network) reads of the next data points overlap with the decoding and augmentation of the current one.
+        Older versions of torch call <__getitem__> directly, and the files are then read one after the other.
+        """
+        paths = [path for path in dict.fromkeys(path for index in indices for path in self.get_paths(index))
+                 if self.cache.get((path, self.opt.load_size)) is None]
+        if paths:
+            pool = self.get_read_pool()
+            for path in paths:
+                self.pending_reads[path] = pool.submit(self.__read_file, path)
+        try:
+            return [self[index] for index in indices]
+        finally:
+            for future in self.pending_reads.values():
+                future.cancel()
+            self.pending_reads.clear()
+
+    def get_read_pool(self):
+        """Return the thread pool of <__getitems__>; it is created once per process, since threads do not survive a fork."""
+        if self.read_pool_pid != os.getpid():
+            self.read_pool = ThreadPoolExecutor(self.read_threads, thread_name_prefix='read')
+            self.read_pool_pid = os.getpid()
+        return self.read_pool
+
+    def __getstate__(self):
+        # e.g., DataLoader workers started with spawn create their own pool
+        state = dict(self.__dict__)
+        state['read_pool'] = state['read_pool_pid'] = None
+        return state
 
     @staticmethod
     def modify_commandline_options(parser, is_train):
@@ -71,104 +176,167 @@ class BaseDataset(data.Dataset, ABC):
         pass
 
 
-def get_params(opt, size):
-    w, h = size
-    new_h = h
-    new_w = w
-    if opt.preprocess == 'resize_and_crop':
-        new_h = new_w = opt.load_size
-    elif opt.preprocess == 'scale_width_and_crop':
-        new_w = opt.load_size
-        new_h = opt.load_size * h // w
-    elif opt.preprocess == 'scale_short_and_crop':
-        min_side = min(h,w)
-        ratio = opt.load_size/min_side
-        new_w = round(w*ratio)
-        new_h = round(h*ratio)
-
-    x = random.randint(0, np.maximum(0, new_w - opt.crop_size))
-    y = random.randint(0, np.maximum(0, new_h - opt.crop_size))
-
-    flip = random.random() > 0.5
-    flip_x = random.random() > 0.5
+def get_params(opt, size, rng=np.random):
+    params, _ = sample_params(opt, size, __no_probs, rng)
+    return params
+
+
+def sample_params(opt, size, probs, rng=np.random):
+    """Sample the params of <get_params> together with a list of random decisions.
+
+    Parameters:
+        opt (Option class)  -- stores all the experiment flags
+        size (tuple)        -- the (w, h) of the image, before the resize of opt.preprocess
+        probs (array)       -- float64 probabilities, e.g., of the --agument_* options
+        rng                 -- the random generator, e.g., a dataset's <rng>
+
+    Returns the params and a boolean array, of which element i is True with probability probs[i].
+    """
+    new_w, new_h = __load_size(opt, size)
+    x, y, flip, flip_x, rotate, flags = __sample_params(max(0, new_w - opt.crop_size), max(0, new_h - opt.crop_size),
+                                                      opt.rotate, probs, rng.random(5 + len(probs)))
+    return {'crop_pos': (x, y), 'flip': flip, 'flip_x': flip_x, 'rotate':rotate}, flags
+
+
+@njit(cache=True)
+def __sample_params(max_x, max_y, max_rotate, probs, rands):
+    x = int(rands[0] * (max_x + 1))
+    y = int(rands[1] * (max_y + 1))
+
+    flip = rands[2] > 0.5
+    flip_x = rands[3] > 0.5
     
-    rotate = random.randint(-opt.rotate, opt.rotate)
+    rotate = int(rands[4] * (2 * max_rotate + 1)) - max_rotate
 
-    return {'crop_pos': (x, y), 'flip': flip, 'flip_x': flip_x, 'rotate':rotate}
+    return x, y, flip, flip_x, rotate, rands[5:] < probs
 
 
-def get_transform(opt, params=None, grayscale=False, method=transforms.InterpolationMode.BICUBIC, convert=True):
-    transform_list = []
-    if grayscale:
-        transform_list.append(transforms.Grayscale(1))
-    if params is not None:
-        if params['rotate']:
-            transform_list.append(transforms.Lambda(lambda img: __rotate(img, params['rotate'])))
-    if 'resize' in opt.preprocess:
-        osize = [opt.load_size, opt.load_size]
-        transform_list.append(transforms.Resize(osize, method))
-    elif 'scale_width' in opt.preprocess:
-        transform_list.append(transforms.Lambda(lambda img: __scale_width(img, opt.load_size, opt.crop_size, method)))
-    elif 'scale_short' in opt.preprocess:
-        transform_list.append(transforms.Lambda(lambda img: __scale_short(img, opt.load_size, method)))
-
-    if 'crop' in opt.preprocess:
-        if params is None:
-            transform_list.append(transforms.RandomCrop(opt.crop_size))
-        else:
-            transform_list.append(transforms.Lambda(lambda img: __crop(img, params['crop_pos'], opt.crop_size)))
-
-    if opt.preprocess == 'none':
-        transform_list.append(transforms.Lambda(lambda img: __make_power_2(img, base=4, method=method)))
-
-    if not opt.no_flip:
-        if params is None:
-            transform_list.append(transforms.RandomHorizontalFlip())
-        else:
-          if params['flip']:
-            transform_list.append(transforms.Lambda(lambda img: __flip(img, params['flip'])))
-          if opt.flip_x and params['flip_x']:
-            transform_list.append(transforms.Lambda(lambda img: __flip_x(img, params['flip_x'])))
-    if params is not None and params.get('blur', 0.0):
-        if random.random() < params.get('blur', 0.0):
-            blur_fn = ["gaussian_blur", "median_blur"]
-            random.shuffle(blur_fn)
-            fn = blur_fn[0]
-            if fn == "gaussian_blur":
-                transform_list.append(transforms.Lambda(lambda img: gaussian_blur(img)))
-            else:
-                transform_list.append(transforms.Lambda(lambda img: median_blur(img)))
-    if params is not None and params.get('distort', 0.0):
-        fs = dict()
-        fs["brightness"]={"f":brightness, "range":0.1}
-        fs["contrast"]={"f":contrast, "range":0.1}
-        fs["saturation"]={"f":saturation, "range":0.1}
-        fs["hue"]={"f":hue, "range":0.1}
-        fs["sharpness"]={"f":sharpness, "range":0.1}
-        for k in fs:
-            if random.random() < params.get('distort', 0.0):
-                v = fs[k]
-                range = v['range']
-                fn = v['f']
-                if fn == 'brightness':
-                    transform_list.append(transforms.Lambda(lambda img:  brightness(img, 1-range, 1+range)))
-                elif fn == 'contrast':
-                    transform_list.append(transforms.Lambda(lambda img:  contrast(img, 1-range, 1+range)))
-                elif fn == 'saturation':
-                    transform_list.append(transforms.Lambda(lambda img:  saturation(img, 1-range, 1+range)))
-                elif fn == 'hue':
-                    transform_list.append(transforms.Lambda(lambda img:  hue(img, 1-range, 1+range)))
-                elif fn == 'sharpness':
-                    transform_list.append(transforms.Lambda(lambda img:  sharpness(img, 1-range, 1+range)))
-    if (not grayscale) and (params is not None) and params.get('grayscale',False):
-        transform_list.append(transforms.Grayscale(3))
-    if convert:
-        transform_list += [transforms.ToTensor()]
-        if grayscale:
-            transform_list += [transforms.Normalize((0.5,), (0.5,))]
-        else:
-            transform_list += [transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))]
-    return transforms.Compose(transform_list)
+__no_probs = np.zeros(0)
+
+
+def get_transform(opt, params=None, grayscale=False, method=transforms.InterpolationMode.BICUBIC, convert=True, rng=np.random):
+    """Return the transform function of a data point; it maps a PIL image (or an HWC uint8 array) to a tensor.
+
+    Parameters:
+        opt (Option class)  -- stores all the experiment flags
+        params (dict)       -- the augmentations sampled by <get_params>; a random crop and horizontal flip are used if None
+        grayscale (bool)    -- convert the image to a single channel
+        method              -- the interpolation of the resize, rotation and crop
+        convert (bool)      -- return a CHW uint8 tensor; otherwise an HWC uint8 numpy array
+        rng                 -- the random generator of the remaining random choices (e.g., a dataset's <rng>)
+
+    The tensors stay uint8 until <CustomDatasetDataLoader> has moved the batch to the device,
+    where it is normalized to [-1, 1] (see <normalize_batch>).
+    Datasets that transform every data point should rather call <compile_transform> once, in their <__init__>.
+    """
+    return functools.partial(compile_transform(opt, grayscale, method, convert), params=params, rng=rng)
+
+
+def compile_transform(opt, grayscale=False, method=transforms.InterpolationMode.BICUBIC, convert=True):
+    """Return the transform function <transform(img, params=None, rng=np.random)> of <get_transform>.
+
+    The branches that only depend on opt and on the arguments are resolved here, once;
+    the returned function runs the remaining steps as straight-line numpy code in <__apply>.
+    """
+    return functools.partial(__apply, opt=opt, crop_size=opt.crop_size if 'crop' in opt.preprocess else None,
+                             flip=not opt.no_flip, flip_x=not opt.no_flip and opt.flip_x,
+                             resample=__transforms2pil_resize(method), interpolation=__transforms2cv2_interpolation(method),
+                             grayscale=grayscale, convert=convert)
+
+
+def __apply(img, params=None, rng=np.random, *, opt, crop_size, flip, flip_x, resample, interpolation, grayscale, convert):
+    arr = np.asarray(img)
+    if grayscale and arr.ndim == 3:
+        arr = cv2.cvtColor(arr, cv2.COLOR_RGB2GRAY)
+
+    size = (arr.shape[1], arr.shape[0])
+    new_size = __load_size(opt, size)
+    if new_size != size:
+        arr = np.asarray(Image.fromarray(arr).resize(new_size, resample))
+
+    if params is None:
+        params = get_params(opt, new_size, rng)
+        params['flip_x'] = False
+        params['rotate'] = 0
+    # rotate, crop and flips are resampled only once; without rotation they are mere views of the array
+    h, w = arr.shape[:2]
+    if not params['rotate'] and (crop_size is None or min(w, h) >= crop_size):
+        arr = __crop_flip(arr, params, crop_size, flip, flip_x)
+    else:
+        arr = __warp_affine(arr, params, crop_size, flip, flip_x, interpolation)
+
+    if params.get('blur', False):
+        blur = __gaussian_blur if rng.random() < 0.5 else __median_blur
+        arr = blur(arr)
+    distort = params.get('distort', False) and arr.ndim == 3
+    if distort:
+        # the other distortions, and then the grayscale, are applied by <distort_batch>, see <get_distort_factors>
+        arr = __hue(arr, rng.uniform(0.9, 1.1))
+    if (not grayscale) and params.get('grayscale', False) and not distort:
+        arr = cv2.cvtColor(cv2.cvtColor(arr, cv2.COLOR_RGB2GRAY), cv2.COLOR_GRAY2RGB)
+
+    if not convert:
+        return arr
+    if arr.ndim == 2:
+        arr = arr[:, :, None]
+    # the only copy of the views of the crop and flips
+    arr = np.ascontiguousarray(arr.transpose(2, 0, 1))
+    if not arr.flags.writeable:  # e.g., an untouched array of the cache
+        arr = arr.copy()
+    return torch.from_numpy(arr)
+
+
+def decode_image(buf, opt, parts=1):
+    """Decode the content <buf> of an image file into a PIL image.
+
+    Parameters:
+        buf (bytes)         -- the content of the image file
+        opt (Option class)  -- the image may be decoded at a lower resolution, as long as it is not smaller than
+                               what opt.preprocess resizes it to
+        parts (int)         -- the number of images placed side by side in the file (e.g., 2 for an AB image)
+
+    JPEGs are downscaled by 1/2, 1/4 or 1/8 in the IDCT while they are decoded, which saves most of the work
+    on images much larger than opt.load_size. They are decoded by libjpeg-turbo if PyTurboJPEG is installed,
+    and otherwise by PIL's <draft> mode.
+    """
+    if turbo_jpeg is not None and buf[:2] == b'\xff\xd8':
+        w, h = turbo_jpeg.decode_header(buf)[:2]
+        part_w, part_h = __load_size(opt, (w // parts, h))
+        try:
+            arr = turbo_jpeg.decode(buf, pixel_format=TJPF_RGB,
+                                    scaling_factor=__jpeg_scaling_factor((w, h), (part_w * parts, part_h)))
+            return Image.fromarray(arr)
+        except OSError:  # e.g., CMYK JPEGs cannot be decoded to RGB
+            pass
+    img = Image.open(io.BytesIO(buf))
+    if img.format == 'JPEG':  # let PIL's libjpeg do the same DCT-domain downscaling
+        part_w, part_h = __load_size(opt, (img.width // parts, img.height))
+        img.draft('RGB', (part_w * parts, part_h))
+    return img
+
+
+def __jpeg_scaling_factor(size, min_size):
+    """Return the smallest libjpeg-turbo scaling factor that keeps an image of <size> at least <min_size>, or None."""
+    w, h = size
+    factors = [(num, denom) for num, denom in turbo_jpeg.scaling_factors
+               if num <= denom and -(-w * num // denom) >= min_size[0] and -(-h * num // denom) >= min_size[1]]
+    if not factors:
+        return None
+    return min(factors, key=lambda f: f[0] / f[1])
+
+
+def resize_image(img, opt, method=transforms.InterpolationMode.BICUBIC):
+    """Resize <img> as required by opt.preprocess; images that already have the target size are returned as they are."""
+    size = __load_size(opt, img.size)
+    if size == img.size:
+        return img
+    resample = __transforms2pil_resize(method)
+    if img.mode == 'RGBA':
+        # PIL premultiplies the colors by alpha while resizing; resize them apart, so that the transparent pixels
+        # keep their colors, as they do when the alpha is simply dropped by convert('RGB')
+        rgb = img.convert('RGB').resize(size, resample)
+        return Image.merge('RGBA', (*rgb.split(), img.getchannel('A').resize(size, resample)))
+    return img.resize(size, resample)
 
 
 def __transforms2pil_resize(method):
@@ -179,60 +347,74 @@ def __transforms2pil_resize(method):
     return mapper[method]
 
 
-def __make_power_2(img, base, method=transforms.InterpolationMode.BICUBIC):
-    method = __transforms2pil_resize(method)
-    ow, oh = img.size
-    h = int(round(oh / base) * base)
-    w = int(round(ow / base) * base)
-    if h == oh and w == ow:
-        return img
-
-    __print_size_warning(ow, oh, w, h)
-    return img.resize((w, h), method)
-
-
-def __scale_width(img, target_size, crop_size, method=transforms.InterpolationMode.BICUBIC):
-    method = __transforms2pil_resize(method)
-    ow, oh = img.size
-    if ow == target_size and oh >= crop_size:
-        return img
-    w = target_size
-    h = int(max(target_size * oh / ow, crop_size))
-    return img.resize((w, h), method)
-
-def __scale_short(img, target_size, method=transforms.InterpolationMode.BICUBIC):
-    method = __transforms2pil_resize(method)
-    ow, oh = img.size
-    min_side = min(ow,oh)
-    if min_side == target_size:
-        return img
-    ratio = target_size/min_side
-    new_w = round(ow*ratio)
-    new_h = round(oh*ratio)
-    return img.resize((new_w, new_h), method)
-
-def __crop(img, pos, size):
-    ow, oh = img.size
-    x1, y1 = pos
-    tw = th = size
-    if (ow > tw or oh > th):
-        return img.crop((x1, y1, x1 + tw, y1 + th))
-    return img
+def __transforms2cv2_interpolation(method):
+    mapper = {transforms.InterpolationMode.BILINEAR: cv2.INTER_LINEAR,
+              transforms.InterpolationMode.BICUBIC: cv2.INTER_CUBIC,
+              transforms.InterpolationMode.NEAREST: cv2.INTER_NEAREST,
+              transforms.InterpolationMode.LANCZOS: cv2.INTER_LANCZOS4,}
+    return mapper[method]
 
-def __rotate(img, rotate):
-    if rotate:
-        return img.rotate(rotate, fillcolor='white')
-    return img
 
-def __flip(img, flip):
-    if flip:
-        return img.transpose(Image.FLIP_LEFT_RIGHT)
-    return img
+def __load_size(opt, size):
+    """Return the (w, h) an image of <size> is resized to by opt.preprocess, before any crop."""
+    ow, oh = size
+    if 'resize' in opt.preprocess:
+        return opt.load_size, opt.load_size
+    elif 'scale_width' in opt.preprocess:
+        if ow == opt.load_size and oh >= opt.crop_size:
+            return ow, oh
+        return opt.load_size, int(max(opt.load_size * oh / ow, opt.crop_size))
+    elif 'scale_short' in opt.preprocess:
+        ratio = opt.load_size / min(ow, oh)
+        return round(ow * ratio), round(oh * ratio)
+    elif opt.preprocess == 'none':
+        # the image size needs to be a multiple of 4
+        w = int(round(ow / 4) * 4)
+        h = int(round(oh / 4) * 4)
+        if w != ow or h != oh:
+            __print_size_warning(ow, oh, w, h)
+        return w, h
+    return ow, oh
+
+
+def __affine_matrix(params, size, crop_size, flip, flip_x):
+    """Compose the rotation, crop and flips given by <params> into a single 2x3 matrix.
+
+    Returns the matrix (in the pixel-center coordinates of cv2) and the (w, h) of the output image.
+    """
+    w, h = size
+    M = np.eye(3)
+    if params['rotate']:
+        # counter-clockwise around the image center, as PIL's Image.rotate
+        M[:2] = cv2.getRotationMatrix2D(((w - 1) / 2, (h - 1) / 2), params['rotate'], 1.0)
+    if crop_size is not None and (w > crop_size or h > crop_size):
+        x, y = params['crop_pos']
+        M = np.array([[1, 0, -x], [0, 1, -y], [0, 0, 1]]) @ M
+        w = h = crop_size
+    if flip and params['flip']:
+        M = np.array([[-1, 0, w - 1], [0, 1, 0], [0, 0, 1]]) @ M
+    if flip_x and params['flip_x']:
+        M = np.array([[1, 0, 0], [0, -1, h - 1], [0, 0, 1]]) @ M
+    return M[:2], (w, h)
+
+
+def __warp_affine(arr, params, crop_size, flip, flip_x, interpolation=cv2.INTER_CUBIC):
+    M, size = __affine_matrix(params, (arr.shape[1], arr.shape[0]), crop_size, flip, flip_x)
+    return cv2.warpAffine(arr, M, size, flags=interpolation,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=(255, 255, 255))
+
+
+def __crop_flip(arr, params, crop_size, flip, flip_x):
+    """The crop and flips of <__affine_matrix> as strided views; a cropped image must be at least <crop_size> large."""
+    if crop_size is not None:
+        x, y = params['crop_pos']
+        arr = arr[y:y + crop_size, x:x + crop_size]
+    if flip and params['flip']:
+        arr = arr[:, ::-1]
+    if flip_x and params['flip_x']:
+        arr = arr[::-1]
+    return arr
 
-def __flip_x(img, flip):
-    if flip:
-        return img.transpose(Image.FLIP_TOP_BOTTOM)
-    return img
 
 def __print_size_warning(ow, oh, w, h):
     """Print warning information about image size(only print once)"""
@@ -244,39 +426,95 @@ def __print_size_warning(ow, oh, w, h):
         __print_size_warning.has_printed = True
 
 def gaussian_blur(im, radius=2):
-    im = im.filter(ImageFilter.GaussianBlur(radius = radius))
-    return im
+    return Image.fromarray(__gaussian_blur(np.asarray(im), radius))
 
 def median_blur(im, size=3):
-    im = im.filter(ImageFilter.MedianFilter(size))
-    return im
-
-def brightness(im, brightness_lower, brightness_upper):
-    brightness_delta = np.random.uniform(brightness_lower, brightness_upper)
-    im = ImageEnhance.Brightness(im).enhance(brightness_delta)
-    return im
+    return Image.fromarray(__median_blur(np.asarray(im), size))
 
-def contrast(im, contrast_lower, contrast_upper):
-    contrast_delta = np.random.uniform(contrast_lower, contrast_upper)
-    im = ImageEnhance.Contrast(im).enhance(contrast_delta)
-    return im
+def __gaussian_blur(arr, radius=2):
+    return cv2.GaussianBlur(arr, (0, 0), sigmaX=radius)
 
-def saturation(im, saturation_lower, saturation_upper):
-    saturation_delta = np.random.uniform(saturation_lower, saturation_upper)
-    im = ImageEnhance.Color(im).enhance(saturation_delta)
-    return im
+def __median_blur(arr, size=3):
+    return cv2.medianBlur(arr, size)
 
 def hue(im, hue_lower, hue_upper):
     hue_delta = np.random.uniform(hue_lower, hue_upper)
-    im = np.array(im.convert('HSV'))
-    im[:, :, 0] = im[:, :, 0] + hue_delta
-    im = Image.fromarray(im, mode='HSV').convert('RGB')
-    return im
+    return Image.fromarray(__hue(np.asarray(im), hue_delta))
+
 
-def sharpness(im, sharpness_lower, sharpness_upper):
-    sharpness_delta = np.random.uniform(sharpness_lower, sharpness_upper)
-    im = ImageEnhance.Sharpness(im).enhance(sharpness_delta)
-    return im
+def __hue(arr, hue_delta):
+    arr = cv2.cvtColor(arr, cv2.COLOR_RGB2HSV)
+    arr[:, :, 0] = (arr[:, :, 0] + hue_delta) % 180  # the hue of OpenCV wraps at 180
+    return cv2.cvtColor(arr, cv2.COLOR_HSV2RGB)
+
+def normalize_batch(images, factors=None):
+    """Convert a batch of uint8 images to floats in [-1, 1], as ToTensor and Normalize((0.5,), (0.5,)) do per image.
+
+    Parameters:
+        images (tensor)  -- (N, C, H, W) uint8 images, preferably already on the device
+        factors (tensor) -- the (N, 5) photometric distortions to apply before the normalization, see <distort_batch>
+    """
+    images = images.float().div_(255)
+    if factors is not None and ((factors[:, :4] != 1).any() or factors[:, 4].any()):
+        images = distort_batch(images, factors)
+    return images.mul_(2).sub_(1)
+
+
+def get_distort_factors(distort, grayscale=False, lower=0.9, upper=1.1, rng=np.random):
+    """Sample the brightness, contrast, saturation and sharpness factors of a data point for <distort_batch>.
+
+    All the factors are 1 (no change) if <distort> is False, so that every data point of a batch has them.
+    The fifth value is 1 if the distorted image must then be converted to grayscale (see <get_transform>), otherwise 0.
+    """
+    if not distort:
+        return torch.tensor([1., 1., 1., 1., 0.])
+    return torch.tensor(list(rng.uniform(lower, upper, 4)) + [float(grayscale)], dtype=torch.float32)
+
+
+def distort_batch(images, factors):
+    """Adjust the brightness, contrast, saturation and sharpness of a batch of images at once.
+
+    Parameters:
+        images (tensor)  -- (N, C, H, W) images in [0, 1], on any device
+        factors (tensor) -- (N, 5) factors from <get_distort_factors>; each one blends an image with a degenerate
+                            version of it (black, mean gray, grayscale, smoothed) as PIL's ImageEnhance does,
+                            and the images flagged by the last column are then converted to grayscale
+    """
+    factors = factors.to(images.device, images.dtype, non_blocking=True)  # pinned by the DataLoader on a GPU
+    brightness, contrast, saturation, sharpness = (factors[:, i].view(-1, 1, 1, 1) for i in range(4))
+    images = __blend(torch.zeros_like(images), images, brightness)
+    images = __blend(__luma(images).mean(dim=(2, 3), keepdim=True), images, contrast)
+    images = __blend(__luma(images), images, saturation)
+    images = __blend(__smooth(images), images, sharpness)
+    if images.shape[1] == 3:
+        images = torch.where(factors[:, 4].view(-1, 1, 1, 1) > 0, __luma(images), images)
+    return images
+
+
+def __blend(degenerate, images, factor):
+    return (degenerate + factor * (images - degenerate)).clamp_(0, 1)
+
+
+def __luma(images):
+    if images.shape[1] == 1:
+        return images
+    weights = images.new_tensor([0.299, 0.587, 0.114]).view(1, 3, 1, 1)
+    return (images * weights).sum(dim=1, keepdim=True)
+
+
+def __smooth(images):
+    """The 3x3 smoothing filter of PIL's ImageFilter.SMOOTH, applied per channel."""
+    c = images.shape[1]
+    kernel = images.new_tensor([[1, 1, 1], [1, 5, 1], [1, 1, 1]]) / 13
+    kernel = kernel.expand(c, 1, 3, 3)
+    return F.conv2d(F.pad(images, (1, 1, 1, 1), mode='replicate'), kernel, groups=c)
+
+
+def alpha_mode(image:Image.Image):
+    """Return 'RGBA' if <image> has the transparency handled by <transparent_to_whiteBK>, otherwise 'RGB'."""
+    if image.mode == 'P':
+        return 'RGBA' if image.palette.mode[-1] == 'A' else 'RGB'
+    return 'RGBA' if image.mode[-1] == 'A' else 'RGB'
 
 
 def transparent_to_whiteBK(image:Image.Image):
@@ -285,10 +523,15 @@ def transparent_to_whiteBK(image:Image.Image):
             image = image.convert(image.palette.mode)
 
     if image.mode[-1] == 'A':
-        new_mode = image.mode[:-1]
-        color = [255]*len(new_mode)
-        new_image = Image.new(new_mode, image.size, color=tuple(color))
-        new_image.paste(image, None, image)
-        return new_image
+        if image.mode not in ('RGBA', 'LA'):
+            image = image.convert('RGBA')
+        return Image.fromarray(alpha_to_white(np.asarray(image)))
     else:
         return image
+
+
+def alpha_to_white(arr):
+    """Composite an HWC uint8 array, whose last channel is alpha, over a white background; the alpha channel is dropped."""
+    alpha = arr[:, :, -1:] * np.float32(1 / 255)
+    out = (arr[:, :, :-1] * alpha + 255 * (1 - alpha) + 0.5).astype(np.uint8)
+    return out[:, :, 0] if out.shape[2] == 1 else out
@@ -1,8 +1,7 @@
 import os
-from data.base_dataset import BaseDataset, get_transform
+from data.base_dataset import BaseDataset, get_transform, decode_image
 from data.image_folder import make_dataset
 from skimage import color  # require skimage
-from PIL import Image
 import numpy as np
 import torchvision.transforms as transforms
 
@@ -54,7 +53,7 @@ class ColorizationDataset(BaseDataset):
             B_paths (str) - - image paths (same as A_paths)
         """
         path = self.AB_paths[index]
-        im = Image.open(path).convert('RGB')
+        im = decode_image(self._read_bytes(path), self.opt).convert('RGB')
         im = self.transform(im)
         im = np.array(im)
         lab = color.rgb2lab(im).astype(np.float32)
@@ -1,6 +1,5 @@
-from data.base_dataset import BaseDataset, get_transform
+from data.base_dataset import BaseDataset, get_transform, decode_image
 from data.image_folder import make_dataset
-from PIL import Image
 
 
 class SingleDataset(BaseDataset):
@@ -31,7 +30,7 @@ class SingleDataset(BaseDataset):
             A_paths(str) - - the path of the image
         """
         A_path = self.A_paths[index]
-        A_img = Image.open(A_path).convert('RGB')
+        A_img = decode_image(self._read_bytes(A_path), self.opt).convert('RGB')
         A = self.transform(A_img)
         return {'A': A, 'A_paths': A_path}
 
@@ -1,10 +1,8 @@
 import os
-import io
+import numpy as np
 
-from data.base_dataset import BaseDataset, get_transform, get_params, transparent_to_whiteBK
+from data.base_dataset import BaseDataset, get_distort_factors, compile_transform, get_params, sample_params, alpha_to_white
 from data.image_folder import make_dataset
-from PIL import Image
-import random
 
 
 class UnalignedDataset(BaseDataset):
@@ -38,6 +36,14 @@ class UnalignedDataset(BaseDataset):
                 self.B_paths.extend(tempB)
         self.A_size = len(self.A_paths)  # get the size of dataset A
         self.B_size = len(self.B_paths)  # get the size of dataset B
+        self.augment_probs = np.array([opt.agument_whiteBK_A, opt.agument_grayscale_A, opt.agument_grayscale_B,
+                                       opt.agument_blur_A, opt.agument_blur_B, opt.agument_distort_A, opt.agument_distort_B],
+                                      dtype=np.float64)
+        btoA = self.opt.direction == 'BtoA'
+        input_nc = self.opt.output_nc if btoA else self.opt.input_nc       # get the number of channels of input image
+        output_nc = self.opt.input_nc if btoA else self.opt.output_nc      # get the number of channels of output image
+        self.transform_A = compile_transform(self.opt, grayscale=(input_nc == 1))
+        self.transform_B = compile_transform(self.opt, grayscale=(output_nc == 1))
 
     def __getitem__(self, index):
         """Return a data point and its metadata information.
@@ -50,43 +56,44 @@ class UnalignedDataset(BaseDataset):
             B (tensor)       -- its corresponding image in the target domain
             A_paths (str)    -- image paths
             B_paths (str)    -- image paths
+            A_distort, B_distort (tensor) -- the photometric distortions of A and B, applied per batch (see <distort_batch>)
         """
         A_path = self.A_paths[index % self.A_size]  # make sure index is within then range
         if self.opt.serial_batches:   # make sure index is within then range
             index_B = index % self.B_size
         else:   # randomize the index for domain B to avoid fixed pairs.
-            index_B = random.randint(0, self.B_size - 1)
+            index_B = int(self.rng.integers(self.B_size))
         B_path = self.B_paths[index_B]
 
-        A_img = Image.open(io.BytesIO(self.get_cache_path(self, A_path)))
-        B_img = Image.open(io.BytesIO(self.get_cache_path(self, B_path))).convert('RGB')
-        
-        
-        if random.random() < self.opt.agument_whiteBK_A:
-            A_img = transparent_to_whiteBK(A_img)
-        A_img = A_img.convert('RGB')
-
+        A_img = self.get_cached_array(A_path)
+        B_img = self.get_cached_array(B_path, keep_alpha=False)
 
         # apply the same transform to both A and B
-        transform_params_A = get_params(self.opt, A_img.size)
-        transform_params_B = get_params(self.opt, B_img.size)
-        transform_params_A['grayscale'] = random.random() < self.opt.agument_grayscale_A
-        transform_params_B['grayscale'] = random.random() < self.opt.agument_grayscale_B
-        transform_params_A['blur'] = random.random() < self.opt.agument_blur_A
-        transform_params_B['blur'] = random.random() < self.opt.agument_blur_B
-        transform_params_A['distort'] = random.random() < self.opt.agument_distort_A
-        transform_params_B['distort'] = random.random() < self.opt.agument_distort_B
-        
-        btoA = self.opt.direction == 'BtoA'
-        input_nc = self.opt.output_nc if btoA else self.opt.input_nc       # get the number of channels of input image
-        output_nc = self.opt.input_nc if btoA else self.opt.output_nc      # get the number of channels of output image
-        transform_A = get_transform(self.opt, transform_params_A, grayscale=(input_nc == 1))
-        transform_B = get_transform(self.opt, transform_params_B, grayscale=(output_nc == 1))
-        # apply image transformation
-        A = transform_A(A_img)
-        B = transform_B(B_img)
+        transform_params_A, r = sample_params(self.opt, (A_img.shape[1], A_img.shape[0]), self.augment_probs, self.rng)
+        transform_params_B = get_params(self.opt, (B_img.shape[1], B_img.shape[0]), self.rng)
+        if A_img.shape[2] == 4:
+            A_img = alpha_to_white(A_img) if r[0] else A_img[:, :, :3]
+        transform_params_A['grayscale'] = r[1]
+        transform_params_B['grayscale'] = r[2]
+        transform_params_A['blur'] = r[3]
+        transform_params_B['blur'] = r[4]
+        transform_params_A['distort'] = r[5]
+        transform_params_B['distort'] = r[6]
 
-        return {'A': A, 'B': B, 'A_paths': A_path, 'B_paths': B_path}
+        # apply image transformation
+        A = self.transform_A(A_img, transform_params_A, self.rng)
+        B = self.transform_B(B_img, transform_params_B, self.rng)
+
+        return {'A': A, 'B': B, 'A_paths': A_path, 'B_paths': B_path,
+                'A_distort': get_distort_factors(transform_params_A['distort'], transform_params_A['grayscale'], rng=self.rng),
+                'B_distort': get_distort_factors(transform_params_B['distort'], transform_params_B['grayscale'], rng=self.rng)}
+
+    def get_paths(self, index):
+        """Return the paths of data point <index>; the B image is unknown in advance unless --serial_batches."""
+        paths = [self.A_paths[index % self.A_size]]
+        if self.opt.serial_batches:
+            paths.append(self.B_paths[index % self.B_size])
+        return paths
 
     def __len__(self):
         """Return the total number of images in the dataset.
@@ -69,7 +69,8 @@ class BaseOptions():
         parser.add_argument('--agument_distort_A', type=float, default=0.0, help='the prop of randomly distort A (brightness, contrast, saturation, sharpness).')
         parser.add_argument('--agument_distort_B', type=float, default=0.0, help='the prop of randomly distort B (brightness, contrast, saturation, sharpness).')
         parser.add_argument('--agument_whiteBK_A', type=float, default=1.0, help='the prop of transparent to whiteBK A.')
-        parser.add_argument('--cache_num', type=int, default=0, help='the image bytes cache num')
+        parser.add_argument('--cache_num', type=int, default=0, help='the number of decoded (and resized) images to cache in memory')
+        parser.add_argument('--cache_mb', type=int, default=4096, help='the maximum size (in MB) of the decoded image cache; shared by all the --num_threads loading processes')
         return parser
 
     def gather_options(self):